@@ -1,8 +1,11 @@
 import sqlite3
+import atexit
 import sys
 import os
 import logging
 import datetime
+import math
+import numpy as np
 
 # settings
 ROOT_FOLDERPATH = os.getcwd()
@@ -19,6 +22,58 @@ logging.basicConfig(
     ]
 )
 
+_connections = {}
+
+def get_connection(db_path):
+    """Get cached database connection, opening it on first use"""
+    conn = _connections.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path, cached_statements=32)  # prepared statements are reused across calls
+        conn.execute('PRAGMA mmap_size=1073741824')  # 1 GB, pages are read from the mapping instead of read() calls
+        conn.execute('PRAGMA cache_size=-65536')  # 64 MB
+        _connections[db_path] = conn
+    return conn
+
+def close_connections():
+    """Close all cached database connections"""
+    for conn in _connections.values():
+        conn.close()
+    _connections.clear()
+
+atexit.register(close_connections)
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE_LAT = math.pi * EARTH_RADIUS_M / 180
+NEAREST_ADDRESS_SEARCH_DELTA = 0.005  # initial half-height of the search box, degrees of latitude
+
+def has_table(cursor, table_name):
+    """Check whether the database contains the given table"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+    return cursor.fetchone() is not None
+
+def find_containing_row(inventory_path, table_name, name_column, path_column, lat, lon):
+    """Find inventory row whose bounding box contains the given coordinates"""
+    cursor = get_connection(inventory_path).cursor()
+    if has_table(cursor, f"{table_name}_rtree"):
+        cursor.execute(f'''
+            SELECT m.{name_column}, m.{path_column}
+            FROM {table_name} m
+            JOIN {table_name}_rtree r ON m.rowid = r.id
+            WHERE r.min_lat <= ? AND r.max_lat >= ?
+            AND r.min_lon <= ? AND r.max_lon >= ?
+            AND ? BETWEEN m.min_lat AND m.max_lat
+            AND ? BETWEEN m.min_lon AND m.max_lon
+        ''', (lat, lat, lon, lon, lat, lon))
+    else:
+        logging.warning(f"ER - Inventory {inventory_path} has no R*Tree index, scanning it; re-run main.py for this region.")
+        cursor.execute(f'''
+            SELECT {name_column}, {path_column}
+            FROM {table_name}
+            WHERE ? BETWEEN min_lat AND max_lat
+            AND ? BETWEEN min_lon AND max_lon
+        ''', (lat, lon))
+    return cursor.fetchone()
+
 def find_country(lat, lon):
     """Find country containing the given coordinates"""
     global_inventory_path = os.path.join(RESULTS_FOLDERPATH, "inventory.sqlite")
@@ -26,16 +81,7 @@ def find_country(lat, lon):
         logging.error("ER - Global inventory database not found.")
         return None
 
-    conn = sqlite3.connect(global_inventory_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT country_name, country_dir 
-        FROM countries 
-        WHERE ? BETWEEN min_lat AND max_lat 
-        AND ? BETWEEN min_lon AND max_lon
-    ''', (lat, lon))
-    result = cursor.fetchone()
-    conn.close()
+    result = find_containing_row(global_inventory_path, 'countries', 'country_name', 'country_dir', lat, lon)
 
     if result:
         country_name, country_dir = result
@@ -52,16 +98,7 @@ def find_region(country_dir, lat, lon):
         logging.error(f"ER - Country inventory database not found at {country_inventory_path}.")
         return None
 
-    conn = sqlite3.connect(country_inventory_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT region_name, region_dir 
-        FROM regions 
-        WHERE ? BETWEEN min_lat AND max_lat 
-        AND ? BETWEEN min_lon AND max_lon
-    ''', (lat, lon))
-    result = cursor.fetchone()
-    conn.close()
+    result = find_containing_row(country_inventory_path, 'regions', 'region_name', 'region_dir', lat, lon)
 
     if result:
         region_name, region_dir = result
@@ -78,16 +115,7 @@ def find_locality(region_dir, lat, lon):
         logging.error(f"ER - Region inventory database not found at {region_inventory_path}.")
         return None
 
-    conn = sqlite3.connect(region_inventory_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT locality_name, db_path 
-        FROM localities 
-        WHERE ? BETWEEN min_lat AND max_lat 
-        AND ? BETWEEN min_lon AND max_lon
-    ''', (lat, lon))
-    result = cursor.fetchone()
-    conn.close()
+    result = find_containing_row(region_inventory_path, 'localities', 'locality_name', 'db_path', lat, lon)
 
     if result:
         locality_name, db_path = result
@@ -97,26 +125,69 @@ def find_locality(region_dir, lat, lon):
         logging.error("ER - No locality found for coordinates ({}, {}).".format(lat, lon))
         return None
 
+def haversine_distance(lat, lon, lats, lons):
+    """Great-circle distance in meters from a point to arrays of points"""
+    lat, lon = math.radians(lat), math.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + math.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def find_address_candidates(cursor, lat, lon, delta):
+    """Select addresses inside the box of +-delta degrees of latitude around the point"""
+    edge_lat = abs(lat) + delta
+    lon_delta = 180.0 if edge_lat >= 90.0 else delta / math.cos(math.radians(edge_lat))
+    min_lon, max_lon = lon - lon_delta, lon + lon_delta
+    if min_lon < -180.0 or max_lon > 180.0:  # box wraps around the antimeridian, search all longitudes
+        min_lon, max_lon = -180.0, 180.0
+    cursor.execute('''
+        SELECT a.street, a.housenumber, a.latitude, a.longitude
+        FROM addresses_rtree r
+        JOIN addresses a ON a.rowid = r.id
+        WHERE r.max_lat >= ? AND r.min_lat <= ?
+        AND r.max_lon >= ? AND r.min_lon <= ?
+    ''', (lat - delta, lat + delta, min_lon, max_lon))
+    return cursor.fetchall()
+
+def find_nearest_row(lat, lon, rows):
+    """Pick the address row nearest to the point, return it with its distance in meters"""
+    lats = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+    lons = np.fromiter((row[3] for row in rows), dtype=np.float64, count=len(rows))
+    distances = haversine_distance(lat, lon, lats, lons)
+    idx = int(np.argmin(distances))
+    return rows[idx], distances[idx]
+
 def find_nearest_address(locality_db_path, lat, lon):
     """Find the nearest address in the locality database"""
     if not os.path.exists(locality_db_path):
         logging.error(f"ER - Locality database not found at {locality_db_path}.")
         return None
 
-    conn = sqlite3.connect(locality_db_path)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT street, housenumber, latitude, longitude,
-               ((latitude - ?) * (latitude - ?) + (longitude - ?) * (longitude - ?)) AS distance
-        FROM addresses
-        ORDER BY distance
-        LIMIT 1
-    ''', (lat, lat, lon, lon))
-    result = cursor.fetchone()
-    conn.close()
+    cursor = get_connection(locality_db_path).cursor()
+    result = None
+    if not has_table(cursor, 'addresses_rtree'):
+        logging.warning(f"ER - Locality database {locality_db_path} has no R*Tree index, scanning it; re-run main.py for this region.")
+        cursor.execute('SELECT street, housenumber, latitude, longitude FROM addresses')
+        rows = cursor.fetchall()
+        if rows:
+            result, distance = find_nearest_row(lat, lon, rows)
+    else:
+        delta = NEAREST_ADDRESS_SEARCH_DELTA
+        while True:
+            rows = find_address_candidates(cursor, lat, lon, delta)
+            if rows:
+                result, distance = find_nearest_row(lat, lon, rows)
+                # The box contains every point within delta degrees of latitude, so a closer match cannot lie outside
+                if distance <= delta * METERS_PER_DEGREE_LAT:
+                    break
+                next_delta = distance / METERS_PER_DEGREE_LAT * 1.001
+            else:
+                next_delta = delta * 2
+            if delta >= 180.0:
+                break
+            delta = min(next_delta, 180.0)
 
     if result:
-        street, housenumber, address_lat, address_lon, distance = result
+        street, housenumber, address_lat, address_lon = result
         logging.info(f"OK - Nearest address found: {street} {housenumber} (lat: {address_lat}, lon: {address_lon})")
         return street, housenumber, address_lat, address_lon
     else:
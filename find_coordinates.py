@@ -1,8 +1,10 @@
 import sqlite3
+import atexit
 import sys
 import os
 import logging
 import datetime
+import re
 
 # setup
 ROOT_FOLDERPATH = os.getcwd()
@@ -19,59 +21,58 @@ logging.basicConfig(
     ]
 )
 
+_connections = {}
+
+def get_connection(db_path):
+    """Get cached database connection, opening it on first use"""
+    conn = _connections.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path, cached_statements=32)  # prepared statements are reused across calls
+        conn.execute('PRAGMA mmap_size=1073741824')  # 1 GB, pages are read from the mapping instead of read() calls
+        conn.execute('PRAGMA cache_size=-65536')  # 64 MB
+        _connections[db_path] = conn
+    return conn
+
+def close_connections():
+    """Close all cached database connections"""
+    for conn in _connections.values():
+        conn.close()
+    _connections.clear()
+
+atexit.register(close_connections)
+
+ADDRESS_PATTERN = re.compile(r'\s*([^,]*?)\s*,\s*([^,]*?)\s*,\s*([^,]*?)\s*,\s*([^,]*?)\s*')
+
 def parse_address(address_str):
     """Parse address string into components"""
-    try:
-        parts = [part.strip() for part in address_str.split(',')]
-        if len(parts) != 4:
-            raise ValueError
-        country, locality, street, housenumber = parts
-        return country.lower(), locality, street, housenumber
-    except ValueError:
+    match = ADDRESS_PATTERN.fullmatch(address_str)
+    if not match:
         logging.error("ER - Invalid address format. Use: 'Country, Locality, Street, Housenumber'")
         sys.exit(1)
+    country, locality, street, housenumber = match.groups()
+    return country.lower(), locality, street, housenumber
 
-def find_country_dir(country):
-    """Find country directory in global inventory"""
-    global_inventory_path = os.path.join(RESULTS_FOLDERPATH, "inventory.sqlite")
-    if not os.path.exists(global_inventory_path):
-        logging.error("ER - Global inventory database not found.")
-        return None
-
-    conn = sqlite3.connect(global_inventory_path)
-    cursor = conn.cursor()
+def find_locality_db_in_regions(cursor, country, locality):
+    """Find locality database by sweeping region inventories of the country"""
     cursor.execute('''
         SELECT country_dir 
         FROM countries 
         WHERE lower(country_name) = ?
     ''', (country,))
     result = cursor.fetchone()
-    conn.close()
-
-    if result:
-        country_dir = os.path.join(ROOT_FOLDERPATH, result[0])
-        logging.info(f"OK - Found country directory: {country_dir}")
-        return country_dir
-    else:
+    if not result:
         logging.error(f"ER - Country '{country}' not found in global inventory.")
         return None
-
-def find_locality_db(country_dir, locality):
-    """Find locality database across all regions in the country"""
-    if not os.path.exists(country_dir):
-        logging.error(f"ER - Country directory {country_dir} does not exist.")
-        return None
+    country_dir = os.path.join(ROOT_FOLDERPATH, result[0])
 
     country_inventory_path = os.path.join(country_dir, "inventory.sqlite")
     if not os.path.exists(country_inventory_path):
         logging.error(f"ER - Country inventory database not found at {country_inventory_path}.")
         return None
 
-    conn = sqlite3.connect(country_inventory_path)
-    cursor = conn.cursor()
+    cursor = get_connection(country_inventory_path).cursor()
     cursor.execute('SELECT region_dir FROM regions')
     regions = [os.path.join(ROOT_FOLDERPATH, row[0]) for row in cursor.fetchall()]
-    conn.close()
 
     for region_dir in regions:
         region_inventory_path = os.path.join(region_dir, "inventory.sqlite")
@@ -79,15 +80,13 @@ def find_locality_db(country_dir, locality):
             logging.warning(f"ER - Region inventory not found at {region_inventory_path}, skipping.")
             continue
 
-        conn = sqlite3.connect(region_inventory_path)
-        cursor = conn.cursor()
+        cursor = get_connection(region_inventory_path).cursor()
         cursor.execute('''
             SELECT db_path 
             FROM localities 
             WHERE locality_name = ?
         ''', (locality,))
         result = cursor.fetchone()
-        conn.close()
 
         if result:
             locality_db_path = os.path.join(ROOT_FOLDERPATH, result[0])
@@ -97,21 +96,47 @@ def find_locality_db(country_dir, locality):
     logging.error(f"ER - Locality '{locality}' not found in any region of {country_dir}.")
     return None
 
+def find_locality_db(country, locality):
+    """Find locality database of the country in global inventory"""
+    global_inventory_path = os.path.join(RESULTS_FOLDERPATH, "inventory.sqlite")
+    if not os.path.exists(global_inventory_path):
+        logging.error("ER - Global inventory database not found.")
+        return None
+
+    cursor = get_connection(global_inventory_path).cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'all_localities'")
+    if cursor.fetchone() is None:
+        logging.warning("ER - Global inventory has no all_localities table, searching region inventories; re-run main.py to build it.")
+        return find_locality_db_in_regions(cursor, country, locality)
+
+    cursor.execute('''
+        SELECT db_path 
+        FROM all_localities 
+        WHERE lower(country_name) = ? AND locality_name = ?
+    ''', (country, locality))
+    result = cursor.fetchone()
+
+    if result:
+        locality_db_path = os.path.join(ROOT_FOLDERPATH, result[0])
+        logging.info(f"OK - Found locality database: {locality_db_path}")
+        return locality_db_path
+    else:
+        logging.error(f"ER - Locality '{locality}' not found for country '{country}' in global inventory.")
+        return None
+
 def find_coordinates(locality_db_path, street, housenumber):
     """Find coordinates for the given street and housenumber in locality database"""
     if not os.path.exists(locality_db_path):
         logging.error(f"ER - Locality database not found at {locality_db_path}.")
         return None
 
-    conn = sqlite3.connect(locality_db_path)
-    cursor = conn.cursor()
+    cursor = get_connection(locality_db_path).cursor()
     cursor.execute('''
         SELECT latitude, longitude 
         FROM addresses 
         WHERE street = ? AND housenumber = ?
     ''', (street, housenumber))
     result = cursor.fetchone()
-    conn.close()
 
     if result:
         lat, lon = result
@@ -125,17 +150,12 @@ def get_coordinates(address_str):
     """Get coordinates for the given address"""
     country, locality, street, housenumber = parse_address(address_str)
 
-    # Step 1: Find country directory
-    country_dir = find_country_dir(country)
-    if not country_dir:
-        return None, "ER - Country not found in global inventory."
-
-    # Step 2: Find locality database
-    locality_db_path = find_locality_db(country_dir, locality)
+    # Step 1: Find locality database
+    locality_db_path = find_locality_db(country, locality)
     if not locality_db_path:
-        return None, "ER - Locality not found in country inventory."
+        return None, "ER - Locality not found in global inventory."
 
-    # Step 3: Find coordinates
+    # Step 2: Find coordinates
     coordinates = find_coordinates(locality_db_path, street, housenumber)
     if not coordinates:
         return None, "ER - Coordinates not found for given address."
@@ -3,44 +3,34 @@ import sqlite3
 import os
 import datetime
 import sys
+import shutil
 import requests
 import tqdm
 from urllib.parse import urlparse
 from bs4 import BeautifulSoup
 import logging
+import functools
+import itertools
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # base settings
 ROOT_FOLDERPATH = os.getcwd()
 SOURCE_FOLDERPATH = os.path.join(ROOT_FOLDERPATH, "source")
 RESULTS_FOLDERPATH = os.path.join(ROOT_FOLDERPATH, "results")
 LOG_FILEPATH = os.path.join(RESULTS_FOLDERPATH, f"osm_processor_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
-
-if not os.path.exists(SOURCE_FOLDERPATH):
-    os.makedirs(SOURCE_FOLDERPATH)
-if not os.path.exists(RESULTS_FOLDERPATH):
-    os.makedirs(RESULTS_FOLDERPATH)
-
-# logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILEPATH),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+NODES_INDEX_TYPE = "sparse_file_array"  # node locations kept on disk instead of in RAM
 
 def download_file(url, filepath):
     """Download file with progress display"""
     logging.info(f"OK - Downloading {url} to {filepath}...")
     response = requests.get(url, stream=True)
+    response.raw.decode_content = True
     total_size = int(response.headers.get('content-length', 0))
-    block_size = 1024  # 1 KB
-    with tqdm.tqdm(total=total_size, unit='B', unit_scale=True, desc="Download") as pbar:
-        with open(filepath, 'wb') as f:
-            for data in response.iter_content(block_size):
-                pbar.update(len(data))
-                f.write(data)
+    block_size = 1024 * 1024  # 1 MB
+    with open(filepath, 'wb') as f:
+        with tqdm.tqdm.wrapattr(f, "write", total=total_size, unit='B', unit_scale=True, desc="Download") as pbar_f:
+            shutil.copyfileobj(response.raw, pbar_f, length=block_size)
     logging.info(f"OK - Download completed: {filepath}")
 
 def get_pbf_links(country):
@@ -104,7 +94,6 @@ def select_pbf_url():
 class AddressCollector(osmium.SimpleHandler):
     def __init__(self, specific_locality=None):
         super().__init__()
-        self.node_refs = set()
         self.addresses = {}
         self.specific_locality = specific_locality
         self.total_ways = 0
@@ -116,65 +105,44 @@ class AddressCollector(osmium.SimpleHandler):
             locality = w.tags['addr:city']
             if self.specific_locality and locality != self.specific_locality:
                 return
-            street = w.tags['addr:street']
-            housenumber = w.tags['addr:housenumber']
-            node_refs = [n.ref for n in w.nodes]
-            self.node_refs.update(node_refs)
-            if locality not in self.addresses:
-                self.addresses[locality] = []
-            self.addresses[locality].append((street, housenumber, node_refs))
+            # Tag values come back as new strings for every way; intern them so repeated names share storage
+            locality = sys.intern(locality)
+            street = sys.intern(w.tags['addr:street'])
+            housenumber = sys.intern(w.tags['addr:housenumber'])
+            lat_sum = lon_sum = 0.0
+            valid_nodes = 0
+            for n in w.nodes:
+                location = n.location
+                if location.valid():
+                    lat_sum += location.lat
+                    lon_sum += location.lon
+                    valid_nodes += 1
+            if valid_nodes:
+                if locality not in self.addresses:
+                    self.addresses[locality] = []
+                self.addresses[locality].append((street, housenumber, lat_sum / valid_nodes, lon_sum / valid_nodes))
         self.processed_ways += 1
         if self.processed_ways % 10000 == 0:
             logging.info(f"OK - Progress processing ways: {self.processed_ways}/{self.total_ways}")
 
-class NodeCollector(osmium.SimpleHandler):
-    def __init__(self, node_refs, nodes_dict):
-        super().__init__()
-        self.node_refs = node_refs
-        self.nodes_dict = nodes_dict
-        self.total_nodes = len(node_refs)
-        self.processed_nodes = 0
-
-    def node(self, n):
-        if n.id in self.node_refs and n.location.valid():
-            self.nodes_dict[n.id] = (n.location.lat, n.location.lon)
-            self.processed_nodes += 1
-            if self.processed_nodes % 100000 == 0:
-                logging.info(f"OK - Progress collecting nodes: {self.processed_nodes}/{self.total_nodes} ({(self.processed_nodes/self.total_nodes)*100:.2f}%)")
+POLISH_LOCALITY_NAME_TRANSLATION = str.maketrans({'ą': 'a', 'ć': 'c', 'ę': 'e', 'ł': 'l', 'ó': 'o', 'ś': 's', 'ź': 'z', 'ż': 'z', ' ': '_'})
+RESTRICTED_LOCALITY_NAME_CHARS = re.compile(r'[^a-z_]')
 
+@functools.lru_cache(maxsize=None)
 def convert_polish_locality_name_to_restricted_in_filesystem(raw_locality_name):
     """Convert locality name to filesystem-safe format"""
     dtmodifier = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     if not raw_locality_name:
         return f"noname_{dtmodifier}"
-    output_locality_name = ""
-    for c in raw_locality_name.lower():
-        if c == 'ą':
-            c = 'a'
-        elif c == ' ':
-            c = '_'
-        elif c == 'ć':
-            c = 'c'
-        elif c == 'ę':
-            c = 'e'
-        elif c == 'ł':
-            c = 'l'
-        elif c == 'ó':
-            c = 'o'
-        elif c == 'ś':
-            c = 's'
-        elif c in 'źż':
-            c = 'z'
-        elif c not in "aąbcdefghijklmnopqrstuvwxyz_":
-            continue
-        output_locality_name += c
+    output_locality_name = RESTRICTED_LOCALITY_NAME_CHARS.sub('', raw_locality_name.lower().translate(POLISH_LOCALITY_NAME_TRANSLATION))
     return output_locality_name or f"noname_{dtmodifier}"
 
 def create_inventory_db(output_dir, addresses, level='region'):
-    """Create inventory database with bounding box data"""
+    """Create inventory database with bounding box data, return inserted rows and their overall bounding box"""
     inventory_db_path = os.path.join(output_dir, "inventory.sqlite")
     conn = sqlite3.connect(inventory_db_path)
     cursor = conn.cursor()
+    cursor.execute('PRAGMA page_size=8192')
 
     if level == 'region':
         table_name = 'localities'
@@ -194,7 +162,12 @@ def create_inventory_db(output_dir, addresses, level='region'):
             {columns}
         )
     ''')
+    cursor.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {table_name}_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+    # Backfill rows of inventories created before the R*Tree existed
+    cursor.execute(f'INSERT INTO {table_name}_rtree SELECT rowid, min_lat, max_lat, min_lon, max_lon FROM {table_name} WHERE rowid NOT IN (SELECT id FROM {table_name}_rtree)')
 
+    inventory_rows = []
+    bounds_min_lat = bounds_max_lat = bounds_min_lon = bounds_max_lon = None
     for name, data in addresses.items():
         if level == 'region':
             locality_filename = convert_polish_locality_name_to_restricted_in_filesystem(name)
@@ -219,51 +192,96 @@ def create_inventory_db(output_dir, addresses, level='region'):
                 f'INSERT INTO {table_name} ({data_key}, {"db_path" if level == "region" else data_key + "_dir"}, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?, ?)',
                 (name, rel_db_path, min_lat, max_lat, min_lon, max_lon)
             )
+            cursor.execute(
+                f'INSERT INTO {table_name}_rtree (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)',
+                (cursor.lastrowid, min_lat, max_lat, min_lon, max_lon)
+            )
+            inventory_rows.append((name, rel_db_path, min_lat, max_lat, min_lon, max_lon))
+            if bounds_min_lat is None:
+                bounds_min_lat, bounds_max_lat, bounds_min_lon, bounds_max_lon = min_lat, max_lat, min_lon, max_lon
+            else:
+                bounds_min_lat = min(bounds_min_lat, min_lat)
+                bounds_max_lat = max(bounds_max_lat, max_lat)
+                bounds_min_lon = min(bounds_min_lon, min_lon)
+                bounds_max_lon = max(bounds_max_lon, max_lon)
 
     conn.commit()
     conn.close()
     logging.info(f"OK - Created inventory database: {inventory_db_path} ({os.path.getsize(inventory_db_path) // 1024} KB)")
+    return inventory_rows, (bounds_min_lat, bounds_max_lat, bounds_min_lon, bounds_max_lon)
+
+def build_locality_db(db_path, address_lists):
+    """Write addresses of the localities sharing one database file"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA page_size=8192')
+    # Locality databases are rebuilt from the .pbf on failure, so trade durability for write speed
+    cursor.execute('PRAGMA journal_mode=MEMORY')
+    cursor.execute('PRAGMA synchronous=OFF')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-262144')  # 256 MB
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS addresses (
+            street TEXT,
+            housenumber TEXT,
+            latitude REAL,
+            longitude REAL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_addr_street_house ON addresses(street, housenumber)')
+    cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS addresses_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+    with conn:
+        # Read the last rowid under the write lock so only this call's rows go into the R*Tree
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT COALESCE(MAX(rowid), 0) FROM addresses')
+        last_rowid = cursor.fetchone()[0]
+        cursor.executemany(
+            'INSERT INTO addresses (street, housenumber, latitude, longitude) VALUES (?, ?, ?, ?)',
+            itertools.chain.from_iterable(address_lists)
+        )
+        cursor.execute(
+            'INSERT INTO addresses_rtree (id, min_lat, max_lat, min_lon, max_lon) '
+            'SELECT rowid, latitude, latitude, longitude, longitude FROM addresses WHERE rowid > ?',
+            (last_rowid,)
+        )
+    conn.close()
 
-def process_addresses_to_db(addresses, nodes_dict, output_dir):
+def process_addresses_to_db(addresses, output_dir):
     localities_dir = os.path.join(output_dir, "localities")
     if not os.path.exists(localities_dir):
         os.makedirs(localities_dir)
 
-    for locality, locality_addresses in addresses.items():
+    # Different names can normalize to the same file (case, noname_*), so group them into one job per file
+    # Only names are grouped, the address lists are passed by reference instead of being copied
+    db_jobs = {}
+    for locality in addresses:
         locality_filename = convert_polish_locality_name_to_restricted_in_filesystem(locality)
         db_path = os.path.join(localities_dir, f"{locality_filename}.sqlite")
-        try:
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS addresses (
-                    street TEXT,
-                    housenumber TEXT,
-                    latitude REAL,
-                    longitude REAL
-                )
-            ''')
-            for street, housenumber, node_refs in locality_addresses:
-                valid_nodes = [nodes_dict.get(ref) for ref in node_refs if ref in nodes_dict]
-                if valid_nodes:
-                    lat = sum(coord[0] for coord in valid_nodes) / len(valid_nodes)
-                    lon = sum(coord[1] for coord in valid_nodes) / len(valid_nodes)
-                    cursor.execute(
-                        'INSERT INTO addresses (street, housenumber, latitude, longitude) VALUES (?, ?, ?, ?)',
-                        (street, housenumber, lat, lon)
-                    )
-            conn.commit()
-            conn.close()
-            logging.info(f"OK - Created database for {locality}: {db_path} ({os.path.getsize(db_path) // 1024} KB)")
-        except Exception as e:
-            logging.error(f"ER - Error creating database {db_path}: {e}")
-            sys.exit(1)
+        db_jobs.setdefault(db_path, []).append(locality)
+
+    # Every job has its own database file, so they are built in parallel
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = {}
+        for db_path, db_localities in db_jobs.items():
+            address_lists = [addresses[locality] for locality in db_localities]
+            futures[executor.submit(build_locality_db, db_path, address_lists)] = (db_localities, db_path)
+
+        for future in as_completed(futures):
+            db_localities, db_path = futures[future]
+            try:
+                future.result()
+                logging.info(f"OK - Created database for {', '.join(db_localities)}: {db_path} ({os.path.getsize(db_path) // 1024} KB)")
+            except Exception as e:
+                logging.error(f"ER - Error creating database {db_path}: {e}")
+                executor.shutdown(cancel_futures=True)
+                sys.exit(1)
 
 def update_country_inventory(country_dir, region, region_bounds):
-    """Update country inventory"""
+    """Update country inventory with region bounds, return the country bounding box"""
     inventory_db_path = os.path.join(country_dir, "inventory.sqlite")
     conn = sqlite3.connect(inventory_db_path)
     cursor = conn.cursor()
+    cursor.execute('PRAGMA page_size=8192')
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS regions (
             region_name TEXT,
@@ -274,20 +292,57 @@ def update_country_inventory(country_dir, region, region_bounds):
             max_lon REAL
         )
     ''')
+    cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS regions_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+    # Backfill rows of inventories created before the R*Tree existed
+    cursor.execute('INSERT INTO regions_rtree SELECT rowid, min_lat, max_lat, min_lon, max_lon FROM regions WHERE rowid NOT IN (SELECT id FROM regions_rtree)')
     rel_region_dir = os.path.relpath(os.path.join(country_dir, region), ROOT_FOLDERPATH)
     cursor.execute(
         'INSERT OR REPLACE INTO regions (region_name, region_dir, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?, ?)',
         (region, rel_region_dir, *region_bounds)
     )
+    cursor.execute(
+        'INSERT OR REPLACE INTO regions_rtree (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)',
+        (cursor.lastrowid, *region_bounds)
+    )
+    cursor.execute('SELECT MIN(min_lat), MAX(max_lat), MIN(min_lon), MAX(max_lon) FROM regions')
+    country_bounds = cursor.fetchone()
     conn.commit()
     conn.close()
     logging.info(f"OK - Updated country inventory: {inventory_db_path}")
+    return country_bounds
+
+def backfill_all_localities(cursor):
+    """Fill all_localities from country and region inventories written before the table existed"""
+    cursor.execute('SELECT DISTINCT country_name, country_dir FROM countries')
+    for country_name, country_dir in cursor.fetchall():
+        country_inventory_path = os.path.join(ROOT_FOLDERPATH, country_dir, "inventory.sqlite")
+        if not os.path.exists(country_inventory_path):
+            logging.warning(f"ER - Country inventory not found at {country_inventory_path}, skipping.")
+            continue
+        country_conn = sqlite3.connect(country_inventory_path)
+        regions = country_conn.execute('SELECT DISTINCT region_name, region_dir FROM regions').fetchall()
+        country_conn.close()
+
+        for region_name, region_dir in regions:
+            region_inventory_path = os.path.join(ROOT_FOLDERPATH, region_dir, "inventory.sqlite")
+            if not os.path.exists(region_inventory_path):
+                logging.warning(f"ER - Region inventory not found at {region_inventory_path}, skipping.")
+                continue
+            region_conn = sqlite3.connect(region_inventory_path)
+            localities = region_conn.execute('SELECT DISTINCT locality_name, db_path, min_lat, max_lat, min_lon, max_lon FROM localities').fetchall()
+            region_conn.close()
+            cursor.executemany(
+                'INSERT INTO all_localities (country_name, region_name, locality_name, db_path, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(country_name, region_name, *locality) for locality in localities]
+            )
+    logging.info("OK - Backfilled all_localities from existing inventories")
 
-def update_global_inventory(country, country_dir, country_bounds):
-    """Update global inventory"""
+def update_global_inventory(country, country_dir, country_bounds, region, localities):
+    """Update global inventory with country bounds and localities of the region"""
     inventory_db_path = os.path.join(RESULTS_FOLDERPATH, "inventory.sqlite")
     conn = sqlite3.connect(inventory_db_path)
     cursor = conn.cursor()
+    cursor.execute('PRAGMA page_size=8192')
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS countries (
             country_name TEXT,
@@ -298,16 +353,61 @@ def update_global_inventory(country, country_dir, country_bounds):
             max_lon REAL
         )
     ''')
+    cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS countries_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+    # Backfill rows of inventories created before the R*Tree existed
+    cursor.execute('INSERT INTO countries_rtree SELECT rowid, min_lat, max_lat, min_lon, max_lon FROM countries WHERE rowid NOT IN (SELECT id FROM countries_rtree)')
     rel_country_dir = os.path.relpath(country_dir, ROOT_FOLDERPATH)
     cursor.execute(
         'INSERT OR REPLACE INTO countries (country_name, country_dir, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?, ?)',
         (country, rel_country_dir, *country_bounds)
     )
+    cursor.execute(
+        'INSERT OR REPLACE INTO countries_rtree (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)',
+        (cursor.lastrowid, *country_bounds)
+    )
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'all_localities'")
+    all_localities_exists = cursor.fetchone() is not None
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS all_localities (
+            country_name TEXT,
+            region_name TEXT,
+            locality_name TEXT,
+            db_path TEXT,
+            min_lat REAL,
+            max_lat REAL,
+            min_lon REAL,
+            max_lon REAL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_all_localities_name ON all_localities(lower(country_name), locality_name)')
+    if not all_localities_exists:
+        backfill_all_localities(cursor)
+    cursor.execute('DELETE FROM all_localities WHERE country_name = ? AND region_name = ?', (country, region))
+    cursor.executemany(
+        'INSERT INTO all_localities (country_name, region_name, locality_name, db_path, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        [(country, region, *locality) for locality in localities]
+    )
     conn.commit()
     conn.close()
     logging.info(f"OK - Updated global inventory: {inventory_db_path}")
 
 if __name__ == "__main__":
+    # Folders and logging are set up here only, worker processes may re-import this module
+    if not os.path.exists(SOURCE_FOLDERPATH):
+        os.makedirs(SOURCE_FOLDERPATH)
+    if not os.path.exists(RESULTS_FOLDERPATH):
+        os.makedirs(RESULTS_FOLDERPATH)
+
+    # logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] - %(message)s',
+        handlers=[
+            logging.FileHandler(LOG_FILEPATH),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+
     # Select URL
     pbf_url = select_pbf_url()
     pbf_filename = os.path.basename(urlparse(pbf_url).path)
@@ -321,6 +421,7 @@ if __name__ == "__main__":
         os.makedirs(output_dir)
 
     source_filepath = os.path.join(SOURCE_FOLDERPATH, pbf_filename)
+    nodes_cache_filepath = os.path.join(SOURCE_FOLDERPATH, f"{pbf_filename}.nodes.cache")
 
     # Download file if it doesn't exist
     if not os.path.exists(source_filepath):
@@ -328,51 +429,36 @@ if __name__ == "__main__":
     else:
         logging.info(f"OK - File {source_filepath} already exists, skipping download.")
 
-    # First pass: collect addresses
-    logging.info("OK - First pass: collecting addresses...")
+    # Single pass: collect addresses with node locations resolved inline
+    logging.info("OK - Collecting addresses...")
     collector = AddressCollector()
-    collector.apply_file(source_filepath)
+    # A cache left behind by a killed run would be reopened with its old entries
+    if os.path.exists(nodes_cache_filepath):
+        os.remove(nodes_cache_filepath)
+    try:
+        # Reject ways without a house number in osmium's C++ filter before they reach the Python callback
+        collector.apply_file(source_filepath, locations=True, idx=f"{NODES_INDEX_TYPE},{nodes_cache_filepath}", filters=[osmium.filter.KeyFilter('addr:housenumber')])
+    finally:
+        if os.path.exists(nodes_cache_filepath):
+            os.remove(nodes_cache_filepath)
     logging.info(f"OK - Collected addresses: {sum(len(v) for v in collector.addresses.values())} for {len(collector.addresses)} localities")
 
-    # Second pass: collect node coordinates
-    logging.info("OK - Second pass: collecting node coordinates...")
-    nodes_dict = {}
-    node_collector = NodeCollector(collector.node_refs, nodes_dict)
-    node_collector.apply_file(source_filepath)
-    logging.info(f"OK - Collected node coordinates: {len(nodes_dict)}")
-
     # Write to locality databases
     logging.info("OK - Writing data to locality databases...")
-    process_addresses_to_db(collector.addresses, nodes_dict, output_dir)
+    process_addresses_to_db(collector.addresses, output_dir)
 
     # Create region inventory
     logging.info("OK - Creating region inventory...")
-    create_inventory_db(output_dir, collector.addresses, level='region')
-
-    # Calculate region bounding box
-    region_inventory_path = os.path.join(output_dir, "inventory.sqlite")
-    conn = sqlite3.connect(region_inventory_path)
-    cursor = conn.cursor()
-    cursor.execute('SELECT MIN(min_lat), MAX(max_lat), MIN(min_lon), MAX(max_lon) FROM localities')
-    region_bounds = cursor.fetchone()
-    conn.close()
+    localities, region_bounds = create_inventory_db(output_dir, collector.addresses, level='region')
 
     # Update country inventory
     if region_bounds[0] is not None:  # If there is data
         logging.info("OK - Updating country inventory...")
-        update_country_inventory(country_dir, region, region_bounds)
-
-        # Calculate country bounding box
-        country_inventory_path = os.path.join(country_dir, "inventory.sqlite")
-        conn = sqlite3.connect(country_inventory_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT MIN(min_lat), MAX(max_lat), MIN(min_lon), MAX(max_lon) FROM regions')
-        country_bounds = cursor.fetchone()
-        conn.close()
+        country_bounds = update_country_inventory(country_dir, region, region_bounds)
 
         # Update global inventory
         if country_bounds[0] is not None:
             logging.info("OK - Updating global inventory...")
-            update_global_inventory(country, country_dir, country_bounds)
+            update_global_inventory(country, country_dir, country_bounds, region, localities)
 
     logging.info("OK - Processing completed!")
\ No newline at end of file